@@ -4,7 +4,9 @@ from sqlalchemy import (
     create_engine,
     Table,
     MetaData,
+    Column,
     Engine,
+    Connection,
     column,
     literal_column,
     text,
@@ -22,13 +24,16 @@ from sqlalchemy import (
     and_,
     union_all,
     case,
+    distinct,
 )
 from sqlalchemy.sql import values, func, alias, lateral, true
+from sqlalchemy import inspect
 import os
 from dataclasses import dataclass, field
 from typing import Literal
 from sqlalchemy.dialects import postgresql
 import sys
+import argparse
 import datetime
 from typing import Optional
 
@@ -180,12 +185,12 @@ def build_table_stmt_onetime(tts: TableTokenizationSpec, table: Table):
     ).cte(f"{tts.table_name}_tokenized")
 
 
-def build_table_stmt_infusion(ttd: TableTokenizationSpec, table: Table):
+def build_table_stmt_infusion(tts: TableTokenizationSpec, table: Table):
     numeric_cols = tts.get_numeric_columns(table)
     categorical_cols = tts.get_categorical_columns(table)
 
     assert len(categorical_cols) == 0, "Categorical infusion events not yet supported"
-    assert len(ttd.modulated_cols) == 0, "Modulated infusion events not yet supported"
+    assert len(tts.modulated_cols) == 0, "Modulated infusion events not yet supported"
 
     tokenization_data_expr = list()
 
@@ -245,7 +250,143 @@ def do_alignment(tts: TableTokenizationSpec, table: Table, icustays: Table):
     return cte
 
 
+def tokenize(tts: TableTokenizationSpec, table: Table):
+    if tts.event_type == "onetime":
+        return build_table_stmt_onetime(tts, table)
+    elif tts.event_type == "infusion":
+        return build_table_stmt_infusion(tts, table)
+
+
+def build_tokenized_cte(tts: TableTokenizationSpec, table: Table, icustays: Table):
+    if tts.needs_alignment:
+        table = do_alignment(tts, table, icustays)  # type: ignore
+
+    return tokenize(tts, table)
+
+
+def compile_cte(cte) -> str:
+    stmt = select(*cte.c).select_from(cte)
+    return str(
+        stmt.compile(
+            dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}
+        )
+    )
+
+
+def explain_analyze(conn: Connection, sql: str) -> dict:
+    """
+    Run a single statement under EXPLAIN ANALYZE
+
+    Returns rows, wall time (ms) and temp spill (MB) of the top plan node, which
+    includes everything below it (e.g. the scan of the statement's input).
+    """
+    res = conn.exec_driver_sql(
+        f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}"
+    ).scalar()
+
+    plan = res[0]["Plan"]  # type: ignore
+
+    return {
+        "rows": plan["Actual Rows"],
+        "time_ms": res[0]["Execution Time"],  # type: ignore
+        "temp_mb": (plan.get("Temp Written Blocks", 0) * 8) / 1024,
+    }
+
+
+def missing_alignment_indexes(engine: Engine, tts: TableTokenizationSpec):
+    """
+    Alignment joins source tables to icustay_detail on subject_id + a charttime
+    range, which wants a (subject_id, charttime) index on the source table
+    """
+    indexes = inspect(engine).get_indexes(tts.table_name, schema=tts.schema)
+
+    if any(i["column_names"][:2] == ["subject_id", "charttime"] for i in indexes):
+        return None
+
+    return (
+        f"CREATE INDEX IF NOT EXISTS {tts.table_name}_sid_time "
+        f"ON {tts.schema}.{tts.table_name}(subject_id, charttime);"
+    )
+
+
+def profile_specs(engine: Engine, metadata: MetaData, icustays: Table):
+    """
+    Run each TableTokenizationSpec's stages separately and report their cost
+
+    Stage timings are exclusive: aligned tables are materialized once into a temp
+    table (the "aligned" row, which includes writing it) and the "tokenized" row reads
+    from that table rather than re-running the join. Every row does include the scan
+    of its own input.
+    """
+    print(
+        f"{'table':<25} {'stage':<10} {'rows':>12} {'time (s)':>10} {'temp (MB)':>10}"
+    )
+
+    def report(tts, stage_name, stats):
+        print(
+            f"{tts.table_name:<25} {stage_name:<10} {stats['rows']:>12} "
+            f"{stats['time_ms'] / 1000:>10.1f} {stats['temp_mb']:>10.1f}"
+        )
+
+    suggestions = list()
+    # Temp tables only live as long as the session, so everything shares a connection
+    with engine.connect() as conn:
+        for tts in TTSs:
+            table = Table(
+                tts.table_name, metadata, autoload_with=engine, schema=tts.schema
+            )
+
+            if tts.needs_alignment:
+                aligned = do_alignment(tts, table, icustays)
+                aligned_name = f"{tts.table_name}_aligned_profile"
+
+                stats = explain_analyze(
+                    conn, f"CREATE TEMP TABLE {aligned_name} AS {compile_cte(aligned)}"
+                )
+                report(tts, "aligned", stats)
+                conn.exec_driver_sql(f"ANALYZE {aligned_name}")
+
+                table = Table(
+                    aligned_name,
+                    MetaData(),
+                    *[Column(c.name, c.type) for c in aligned.c],
+                )
+
+                suggestion = missing_alignment_indexes(engine, tts)
+                if suggestion is not None:
+                    suggestions.append(suggestion)
+
+            stats = explain_analyze(conn, compile_cte(tokenize(tts, table)))
+            report(tts, "tokenized", stats)
+
+            if tts.needs_alignment:
+                conn.exec_driver_sql(f"DROP TABLE {table.name}")
+
+    icustay_indexes = inspect(engine).get_indexes(
+        "icustay_detail", schema="mimiciv_derived"
+    )
+    if not any(i["column_names"][:1] == ["subject_id"] for i in icustay_indexes):
+        suggestions.append(
+            "CREATE INDEX IF NOT EXISTS icustay_detail_sid_intime "
+            "ON mimiciv_derived.icustay_detail(subject_id, icu_intime);"
+        )
+
+    if suggestions:
+        print()
+        print("-- Suggested indexes")
+        for suggestion in suggestions:
+            print(suggestion)
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Report per-table tokenization cost instead of printing sql",
+    )
+    args = parser.parse_args()
+
     user = os.environ.get("PGUSER", "postgres")
     password = os.environ.get("PGPASSWORD", "")
     host = os.environ.get("PGHOST", "localhost")
@@ -260,20 +401,16 @@ if __name__ == "__main__":
         "icustay_detail", metadata, autoload_with=engine, schema="mimiciv_derived"
     )
 
+    if args.profile:
+        profile_specs(engine, metadata, icustays)
+        sys.exit(0)
+
     # Generate event tokens
     ctes_for_union = list()
 
     for tts in TTSs:
         table = Table(tts.table_name, metadata, autoload_with=engine, schema=tts.schema)
-
-        if tts.needs_alignment:
-            alignment_cte = do_alignment(tts, table, icustays)
-            table = alignment_cte
-
-        if tts.event_type == "onetime":
-            ctes_for_union.append(build_table_stmt_onetime(tts, table))  # type: ignore
-        elif tts.event_type == "infusion":
-            ctes_for_union.append(build_table_stmt_infusion(tts, table))  # type: ignore
+        ctes_for_union.append(build_tokenized_cte(tts, table, icustays))
 
     # Generate special tokens (hr, admission, discharge, death)
     hour_cte = (
@@ -342,6 +479,8 @@ if __name__ == "__main__":
     ctes_for_union += [hour_cte, admission_cte, discharge_cte, mort_cte]
 
     # Union all subqueries together
+    # Token kinds are carried through to d_tokens, so the decoder never has to guess
+    # what a token is from its string
     union_cte = union_all(
         *[
             select(
@@ -350,6 +489,7 @@ if __name__ == "__main__":
                 cte.c.token_label,
                 cte.c.token_value_numeric,
                 cte.c.token_value_categorical,
+                literal("hour" if cte is hour_cte else "label").label("label_kind"),
             )
             for cte in ctes_for_union
         ]
@@ -388,6 +528,11 @@ if __name__ == "__main__":
                 ),
                 union_cte.c.token_value_categorical,
             ).label("token_value"),
+            union_cte.c.label_kind,
+            case(
+                (union_cte.c.token_value_numeric != None, "magnitude"),
+                else_="value",
+            ).label("value_kind"),
         )
         .order_by("stay_id", "charttime")
         .cte("token_values")
@@ -444,6 +589,8 @@ if __name__ == "__main__":
                 * PERCENTILE_MULTIPLIER
             ).cast(TEXT),
         ).label("token_value"),
+        literal("label").label("label_kind"),
+        literal("magnitude").label("value_kind"),
     ).cte("med_values")
 
     med_derived_events_combined_cte = union_all(
@@ -453,6 +600,8 @@ if __name__ == "__main__":
             med_values_cte.c.token_label,
             med_values_cte.c.token_value,
             med_values_cte.c.uom_label,
+            med_values_cte.c.label_kind,
+            med_values_cte.c.value_kind,
         ).select_from(med_values_cte),
         select(
             token_value_cte.c.stay_id,
@@ -460,6 +609,8 @@ if __name__ == "__main__":
             token_value_cte.c.token_label,
             token_value_cte.c.token_value,
             literal(None).label("uom_label"),
+            token_value_cte.c.label_kind,
+            token_value_cte.c.value_kind,
         ).select_from(token_value_cte),
     ).cte("med_derived_events_combined")
 
@@ -471,6 +622,8 @@ if __name__ == "__main__":
             med_derived_events_combined_cte.c.token_label,
             med_derived_events_combined_cte.c.token_value,
             med_derived_events_combined_cte.c.uom_label,
+            med_derived_events_combined_cte.c.label_kind,
+            med_derived_events_combined_cte.c.value_kind,
             func.row_number()
             .over(
                 partition_by=(
@@ -494,6 +647,7 @@ if __name__ == "__main__":
                 numbered_events_cte.c.stay_id,
                 numbered_events_cte.c.charttime,
                 numbered_events_cte.c.token_label.label("token"),
+                numbered_events_cte.c.label_kind.label("token_kind"),
                 numbered_events_cte.c.event_idx,
                 literal(1).label("sort_order"),
             ).select_from(numbered_events_cte),
@@ -501,6 +655,7 @@ if __name__ == "__main__":
                 numbered_events_cte.c.stay_id,
                 numbered_events_cte.c.charttime,
                 numbered_events_cte.c.uom_label.label("token"),
+                literal("uom").label("token_kind"),
                 numbered_events_cte.c.event_idx,
                 literal(2).label("sort_order"),
             )
@@ -510,6 +665,7 @@ if __name__ == "__main__":
                 numbered_events_cte.c.stay_id,
                 numbered_events_cte.c.charttime,
                 numbered_events_cte.c.token_value.label("token"),
+                numbered_events_cte.c.value_kind.label("token_kind"),
                 numbered_events_cte.c.event_idx,
                 literal(3).label("sort_order"),
             )
@@ -535,11 +691,13 @@ if __name__ == "__main__":
         .cte("d_tokens")
     )
 
+    # token_kind only feeds d_tokens.token_kinds, token ids stay keyed on the string
     stmt = select(
         token_stream_cte.c.stay_id,
         token_stream_cte.c.charttime,
         d_tokens_cte.c.token_id,
         token_stream_cte.c.token,
+        token_stream_cte.c.token_kind,
     ).join(d_tokens_cte, d_tokens_cte.c.token == token_stream_cte.c.token)
 
     print(f"-- Do not edit directly: autogenerated sql")
@@ -556,7 +714,12 @@ if __name__ == "__main__":
     )
 
     d_tokens = (
-        select(column("token_id"), column("token"))
+        select(
+            column("token_id"),
+            column("token"),
+            # Every role the string is used in, e.g. {uom,value} for "mL"
+            func.array_agg(distinct(column("token_kind"))).label("token_kinds"),
+        )
         .select_from(text("mimiciv_local.tokenevents"))
         .group_by(column("token_id"), column("token"))
     )
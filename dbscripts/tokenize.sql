@@ -43,7 +43,9 @@ CREATE TABLE mimiciv_local.tokenevents AS (
                         ) * 10
                     ) AS TEXT
                 )
-            ) AS token_value
+            ) AS token_value,
+            'label' AS label_kind,
+            'magnitude' AS value_kind
         FROM meds
     ),
     vitalsign_tokenized AS (
@@ -1336,133 +1338,152 @@ CREATE TABLE mimiciv_local.tokenevents AS (
             vitalsign_tokenized.charttime AS charttime,
             vitalsign_tokenized.token_label AS token_label,
             vitalsign_tokenized.token_value_numeric AS token_value_numeric,
-            vitalsign_tokenized.token_value_categorical AS token_value_categorical
+            vitalsign_tokenized.token_value_categorical AS token_value_categorical,
+            'label' AS label_kind
         FROM vitalsign_tokenized
         UNION ALL
         SELECT crrt_tokenized.stay_id AS stay_id,
             crrt_tokenized.charttime AS charttime,
             crrt_tokenized.token_label AS token_label,
             crrt_tokenized.token_value_numeric AS token_value_numeric,
-            crrt_tokenized.token_value_categorical AS token_value_categorical
+            crrt_tokenized.token_value_categorical AS token_value_categorical,
+            'label' AS label_kind
         FROM crrt_tokenized
         UNION ALL
         SELECT chemistry_tokenized.stay_id AS stay_id,
             chemistry_tokenized.charttime AS charttime,
             chemistry_tokenized.token_label AS token_label,
             chemistry_tokenized.token_value_numeric AS token_value_numeric,
-            chemistry_tokenized.token_value_categorical AS token_value_categorical
+            chemistry_tokenized.token_value_categorical AS token_value_categorical,
+            'label' AS label_kind
         FROM chemistry_tokenized
         UNION ALL
         SELECT complete_blood_count_tokenized.stay_id AS stay_id,
             complete_blood_count_tokenized.charttime AS charttime,
             complete_blood_count_tokenized.token_label AS token_label,
             complete_blood_count_tokenized.token_value_numeric AS token_value_numeric,
-            complete_blood_count_tokenized.token_value_categorical AS token_value_categorical
+            complete_blood_count_tokenized.token_value_categorical AS token_value_categorical,
+            'label' AS label_kind
         FROM complete_blood_count_tokenized
         UNION ALL
         SELECT blood_differential_tokenized.stay_id AS stay_id,
             blood_differential_tokenized.charttime AS charttime,
             blood_differential_tokenized.token_label AS token_label,
             blood_differential_tokenized.token_value_numeric AS token_value_numeric,
-            blood_differential_tokenized.token_value_categorical AS token_value_categorical
+            blood_differential_tokenized.token_value_categorical AS token_value_categorical,
+            'label' AS label_kind
         FROM blood_differential_tokenized
         UNION ALL
         SELECT bg_tokenized.stay_id AS stay_id,
             bg_tokenized.charttime AS charttime,
             bg_tokenized.token_label AS token_label,
             bg_tokenized.token_value_numeric AS token_value_numeric,
-            bg_tokenized.token_value_categorical AS token_value_categorical
+            bg_tokenized.token_value_categorical AS token_value_categorical,
+            'label' AS label_kind
         FROM bg_tokenized
         UNION ALL
         SELECT cardiac_marker_tokenized.stay_id AS stay_id,
             cardiac_marker_tokenized.charttime AS charttime,
             cardiac_marker_tokenized.token_label AS token_label,
             cardiac_marker_tokenized.token_value_numeric AS token_value_numeric,
-            cardiac_marker_tokenized.token_value_categorical AS token_value_categorical
+            cardiac_marker_tokenized.token_value_categorical AS token_value_categorical,
+            'label' AS label_kind
         FROM cardiac_marker_tokenized
         UNION ALL
         SELECT coagulation_tokenized.stay_id AS stay_id,
             coagulation_tokenized.charttime AS charttime,
             coagulation_tokenized.token_label AS token_label,
             coagulation_tokenized.token_value_numeric AS token_value_numeric,
-            coagulation_tokenized.token_value_categorical AS token_value_categorical
+            coagulation_tokenized.token_value_categorical AS token_value_categorical,
+            'label' AS label_kind
         FROM coagulation_tokenized
         UNION ALL
         SELECT enzyme_tokenized.stay_id AS stay_id,
             enzyme_tokenized.charttime AS charttime,
             enzyme_tokenized.token_label AS token_label,
             enzyme_tokenized.token_value_numeric AS token_value_numeric,
-            enzyme_tokenized.token_value_categorical AS token_value_categorical
+            enzyme_tokenized.token_value_categorical AS token_value_categorical,
+            'label' AS label_kind
         FROM enzyme_tokenized
         UNION ALL
         SELECT icp_tokenized.stay_id AS stay_id,
             icp_tokenized.charttime AS charttime,
             icp_tokenized.token_label AS token_label,
             icp_tokenized.token_value_numeric AS token_value_numeric,
-            icp_tokenized.token_value_categorical AS token_value_categorical
+            icp_tokenized.token_value_categorical AS token_value_categorical,
+            'label' AS label_kind
         FROM icp_tokenized
         UNION ALL
         SELECT urine_output_tokenized.stay_id AS stay_id,
             urine_output_tokenized.charttime AS charttime,
             urine_output_tokenized.token_label AS token_label,
             urine_output_tokenized.token_value_numeric AS token_value_numeric,
-            urine_output_tokenized.token_value_categorical AS token_value_categorical
+            urine_output_tokenized.token_value_categorical AS token_value_categorical,
+            'label' AS label_kind
         FROM urine_output_tokenized
         UNION ALL
         SELECT ventilator_setting_tokenized.stay_id AS stay_id,
             ventilator_setting_tokenized.charttime AS charttime,
             ventilator_setting_tokenized.token_label AS token_label,
             ventilator_setting_tokenized.token_value_numeric AS token_value_numeric,
-            ventilator_setting_tokenized.token_value_categorical AS token_value_categorical
+            ventilator_setting_tokenized.token_value_categorical AS token_value_categorical,
+            'label' AS label_kind
         FROM ventilator_setting_tokenized
         UNION ALL
         SELECT inflammation_tokenized.stay_id AS stay_id,
             inflammation_tokenized.charttime AS charttime,
             inflammation_tokenized.token_label AS token_label,
             inflammation_tokenized.token_value_numeric AS token_value_numeric,
-            inflammation_tokenized.token_value_categorical AS token_value_categorical
+            inflammation_tokenized.token_value_categorical AS token_value_categorical,
+            'label' AS label_kind
         FROM inflammation_tokenized
         UNION ALL
         SELECT rhythm_tokenized.stay_id AS stay_id,
             rhythm_tokenized.charttime AS charttime,
             rhythm_tokenized.token_label AS token_label,
             rhythm_tokenized.token_value_numeric AS token_value_numeric,
-            rhythm_tokenized.token_value_categorical AS token_value_categorical
+            rhythm_tokenized.token_value_categorical AS token_value_categorical,
+            'label' AS label_kind
         FROM rhythm_tokenized
         UNION ALL
         SELECT bcresults_tokenized.stay_id AS stay_id,
             bcresults_tokenized.charttime AS charttime,
             bcresults_tokenized.token_label AS token_label,
             bcresults_tokenized.token_value_numeric AS token_value_numeric,
-            bcresults_tokenized.token_value_categorical AS token_value_categorical
+            bcresults_tokenized.token_value_categorical AS token_value_categorical,
+            'label' AS label_kind
         FROM bcresults_tokenized
         UNION ALL
         SELECT hour_events.stay_id AS stay_id,
             hour_events.charttime AS charttime,
             hour_events.token_label AS token_label,
             hour_events.token_value_numeric AS token_value_numeric,
-            hour_events.token_value_categorical AS token_value_categorical
+            hour_events.token_value_categorical AS token_value_categorical,
+            'hour' AS label_kind
         FROM hour_events
         UNION ALL
         SELECT admission_events.stay_id AS stay_id,
             admission_events.charttime AS charttime,
             admission_events.token_label AS token_label,
             admission_events.token_value_numeric AS token_value_numeric,
-            admission_events.token_value_categorical AS token_value_categorical
+            admission_events.token_value_categorical AS token_value_categorical,
+            'label' AS label_kind
         FROM admission_events
         UNION ALL
         SELECT discharge_events.stay_id AS stay_id,
             discharge_events.charttime AS charttime,
             discharge_events.token_label AS token_label,
             discharge_events.token_value_numeric AS token_value_numeric,
-            discharge_events.token_value_categorical AS token_value_categorical
+            discharge_events.token_value_categorical AS token_value_categorical,
+            'label' AS label_kind
         FROM discharge_events
         UNION ALL
         SELECT mort_events.stay_id AS stay_id,
             mort_events.charttime AS charttime,
             mort_events.token_label AS token_label,
             mort_events.token_value_numeric AS token_value_numeric,
-            mort_events.token_value_categorical AS token_value_categorical
+            mort_events.token_value_categorical AS token_value_categorical,
+            'label' AS label_kind
         FROM mort_events
     ),
     token_values AS (
@@ -1484,7 +1505,12 @@ CREATE TABLE mimiciv_local.tokenevents AS (
                     )
                 END,
                 union_tokenized.token_value_categorical
-            ) AS token_value
+            ) AS token_value,
+            union_tokenized.label_kind AS label_kind,
+            CASE
+                WHEN (union_tokenized.token_value_numeric IS NOT NULL) THEN 'magnitude'
+                ELSE 'value'
+            END AS value_kind
         FROM union_tokenized
         ORDER BY union_tokenized.stay_id,
             union_tokenized.charttime
@@ -1494,14 +1520,18 @@ CREATE TABLE mimiciv_local.tokenevents AS (
             med_values.charttime AS charttime,
             med_values.token_label AS token_label,
             med_values.token_value AS token_value,
-            med_values.uom_label AS uom_label
+            med_values.uom_label AS uom_label,
+            med_values.label_kind AS label_kind,
+            med_values.value_kind AS value_kind
         FROM med_values
         UNION ALL
         SELECT token_values.stay_id AS stay_id,
             token_values.charttime AS charttime,
             token_values.token_label AS token_label,
             token_values.token_value AS token_value,
-            NULL AS uom_label
+            NULL AS uom_label,
+            token_values.label_kind AS label_kind,
+            token_values.value_kind AS value_kind
         FROM token_values
     ),
     numbered_events AS (
@@ -1510,6 +1540,8 @@ CREATE TABLE mimiciv_local.tokenevents AS (
             med_derived_events_combined.token_label AS token_label,
             med_derived_events_combined.token_value AS token_value,
             med_derived_events_combined.uom_label AS uom_label,
+            med_derived_events_combined.label_kind AS label_kind,
+            med_derived_events_combined.value_kind AS value_kind,
             row_number() OVER (
                 PARTITION BY med_derived_events_combined.stay_id,
                 med_derived_events_combined.charttime
@@ -1522,6 +1554,7 @@ CREATE TABLE mimiciv_local.tokenevents AS (
         SELECT numbered_events.stay_id AS stay_id,
             numbered_events.charttime AS charttime,
             numbered_events.token_label AS token,
+            numbered_events.label_kind AS token_kind,
             numbered_events.event_idx AS event_idx,
             1 AS sort_order
         FROM numbered_events
@@ -1529,6 +1562,7 @@ CREATE TABLE mimiciv_local.tokenevents AS (
         SELECT numbered_events.stay_id AS stay_id,
             numbered_events.charttime AS charttime,
             numbered_events.uom_label AS token,
+            'uom' AS token_kind,
             numbered_events.event_idx AS event_idx,
             2 AS sort_order
         FROM numbered_events
@@ -1537,6 +1571,7 @@ CREATE TABLE mimiciv_local.tokenevents AS (
         SELECT numbered_events.stay_id AS stay_id,
             numbered_events.charttime AS charttime,
             numbered_events.token_value AS token,
+            numbered_events.value_kind AS token_kind,
             numbered_events.event_idx AS event_idx,
             3 AS sort_order
         FROM numbered_events
@@ -1561,7 +1596,8 @@ CREATE TABLE mimiciv_local.tokenevents AS (
     SELECT token_stream.stay_id,
         token_stream.charttime,
         d_tokens.token_id,
-        token_stream.token
+        token_stream.token,
+        token_stream.token_kind
     FROM token_stream
         JOIN d_tokens ON d_tokens.token = token_stream.token
 );
@@ -1569,7 +1605,8 @@ CREATE INDEX IF NOT EXISTS sid_time ON mimiciv_local.tokenevents(stay_id, chartt
 DROP TABLE IF EXISTS mimiciv_local.d_tokens;
 CREATE TABLE mimiciv_local.d_tokens AS (
     SELECT token_id,
-        token
+        token,
+        array_agg(DISTINCT token_kind) AS token_kinds
     FROM mimiciv_local.tokenevents
     GROUP BY token_id,
         token
@@ -0,0 +1,184 @@
+import psycopg2
+import numpy as np
+import os
+from typing import Optional
+
+
+def default_cache_dir() -> str:
+    return os.environ.get(
+        "EMRGPT_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "emrgptdata"),
+    )
+
+
+def db_fingerprint(cursor) -> str:
+    """
+    Cheap identifier for the current build of the local tables
+
+    All of mimiciv_local is built with DROP / CREATE, so a rebuild always changes the
+    table oids. Reading them is a catalog lookup and doesn't touch any data.
+    """
+    cursor.execute(
+        """
+        --sql
+        SELECT 'mimiciv_local.tokenevents'::regclass::oid,
+            'mimiciv_local.d_tokens'::regclass::oid,
+            'mimiciv_local.splits'::regclass::oid;
+        """
+    )
+
+    return "-".join(str(i) for i in cursor.fetchone())
+
+
+class StayIndex:
+    """
+    Per-split metadata for every ICU stay in tokenevents, as numpy arrays sorted by stay_id
+
+    Built once with a single aggregate query and cached to disk, so datasets (and every
+    DataLoader worker) can be constructed without hitting the database.
+    """
+
+    def __init__(
+        self,
+        stay_ids: np.ndarray,
+        lengths: np.ndarray,
+        hours: np.ndarray,
+        first_charttime: np.ndarray,
+        last_charttime: np.ndarray,
+        fingerprint: str,
+    ):
+        self.stay_ids = stay_ids
+        self.lengths = lengths
+        self.hours = hours
+        self.first_charttime = first_charttime
+        self.last_charttime = last_charttime
+        self.fingerprint = fingerprint
+
+    def __len__(self):
+        return len(self.stay_ids)
+
+    def filter(self, min_length: int) -> "StayIndex":
+        keep = self.lengths >= min_length
+
+        return StayIndex(
+            self.stay_ids[keep],
+            self.lengths[keep],
+            self.hours[keep],
+            self.first_charttime[keep],
+            self.last_charttime[keep],
+            self.fingerprint,
+        )
+
+    def positions(self, stay_ids) -> np.ndarray:
+        """
+        Map stay_ids to their row in this index
+        """
+        stay_ids = np.asarray(stay_ids)
+        pos = np.searchsorted(self.stay_ids, stay_ids)
+        assert np.all(pos < len(self.stay_ids)), "Unknown stay_id"
+        assert np.all(self.stay_ids[pos] == stay_ids), "Unknown stay_id"
+
+        return pos
+
+    @staticmethod
+    def _path(cache_dir: str, testset: bool) -> str:
+        return os.path.join(
+            cache_dir, f"stayindex_{'test' if testset else 'train'}.npz"
+        )
+
+    @classmethod
+    def build(cls, testset: bool = False) -> "StayIndex":
+        c = psycopg2.connect("")
+        cursor = c.cursor()
+
+        fingerprint = db_fingerprint(cursor)
+        cursor.execute(
+            """
+            --sql
+            SELECT s.stay_id,
+                count(t.token_id),
+                count(t.token_id) FILTER (WHERE t.token LIKE 'hour.%%'),
+                min(t.charttime),
+                max(t.charttime)
+            FROM mimiciv_local.splits s
+            LEFT JOIN mimiciv_local.tokenevents t ON t.stay_id = s.stay_id
+            WHERE s.testset = %s
+            GROUP BY s.stay_id
+            ORDER BY s.stay_id;
+            """,
+            ("true" if testset else "false",),
+        )
+
+        res = cursor.fetchall()
+        c.close()
+
+        return cls(
+            stay_ids=np.array([i[0] for i in res], dtype=np.int64),
+            lengths=np.array([i[1] for i in res], dtype=np.int64),
+            hours=np.array([i[2] for i in res], dtype=np.int64),
+            # Stays with no tokens get NaT
+            first_charttime=np.array([i[3] for i in res], dtype="datetime64[us]"),
+            last_charttime=np.array([i[4] for i in res], dtype="datetime64[us]"),
+            fingerprint=fingerprint,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "StayIndex":
+        with np.load(path) as f:
+            return cls(
+                stay_ids=f["stay_ids"],
+                lengths=f["lengths"],
+                hours=f["hours"],
+                first_charttime=f["first_charttime"],
+                last_charttime=f["last_charttime"],
+                fingerprint=str(f["fingerprint"]),
+            )
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write-then-rename so concurrent readers never see a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_path,
+            stay_ids=self.stay_ids,
+            lengths=self.lengths,
+            hours=self.hours,
+            first_charttime=self.first_charttime,
+            last_charttime=self.last_charttime,
+            fingerprint=np.array(self.fingerprint),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load_or_build(
+        cls,
+        testset: bool = False,
+        cache_dir: Optional[str] = None,
+        verify: bool = True,
+    ) -> "StayIndex":
+        """
+        Load the cached index for a split, rebuilding it if missing or stale
+
+        With verify=False the cached index is trusted as-is and no connection is made.
+        """
+        path = cls._path(cache_dir or default_cache_dir(), testset)
+
+        if os.path.exists(path):
+            index = cls.load(path)
+
+            if not verify:
+                return index
+
+            c = psycopg2.connect("")
+            fingerprint = db_fingerprint(c.cursor())
+            c.close()
+
+            if index.fingerprint == fingerprint:
+                return index
+
+            print(f"Stay index at {path} is stale, rebuilding")
+
+        index = cls.build(testset)
+        index.save(path)
+
+        return index
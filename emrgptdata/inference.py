@@ -0,0 +1,324 @@
+import psycopg2
+import psycopg2.extras
+import torch
+import numpy as np
+from typing import Optional
+from emrgptdata.mimic import PostgresUtil
+from emrgptdata.store import TokenStore
+
+
+# Token kinds, from the token_kinds column of mimiciv_local.d_tokens
+KIND_NOP, KIND_HOUR, KIND_LABEL, KIND_UOM, KIND_MAGNITUDE, KIND_VALUE = range(6)
+KINDS = {
+    "nop": KIND_NOP,
+    "hour": KIND_HOUR,
+    "label": KIND_LABEL,
+    "uom": KIND_UOM,
+    "magnitude": KIND_MAGNITUDE,
+    "value": KIND_VALUE,
+}
+
+EVENT_DTYPE = np.dtype(
+    [
+        ("seq", np.int32),
+        ("pos", np.int32),
+        ("label", np.int32),
+        ("uom", np.int32),
+        ("bin", np.int8),
+        ("value", np.int32),
+        ("hour", np.int8),
+    ]
+)
+
+
+class TokenDecoder:
+    """
+    Vectorized conversion of token ids back into structured events
+
+    The token stream is a sequence of events, each a label token optionally followed
+    by a unit of measure token (medications) and a value token (magnitude.N for
+    numeric values, the raw category otherwise), interleaved with hour.N tokens. Every
+    token's kind is read from d_tokens and precomputed into lookup tables over token
+    ids, so decoding a batch of sequences is a handful of numpy gathers.
+    """
+
+    def __init__(self, postgresUtil: PostgresUtil):
+        c = psycopg2.connect("")
+        cursor = c.cursor()
+
+        # Only decoding needs kinds, so older builds of d_tokens are fine for training
+        cursor.execute(
+            """
+            --sql
+            SELECT count(*) FROM information_schema.columns WHERE
+            table_name = 'd_tokens' AND table_schema = 'mimiciv_local'
+            AND column_name = 'token_kinds';
+            """
+        )
+        assert (
+            cursor.fetchone()[0] == 1
+        ), "mimiciv_local.d_tokens has no token_kinds, rebuild it with tokenize.sql"
+
+        cursor.execute(
+            """
+            --sql
+            SELECT token_id, token_kinds FROM mimiciv_local.d_tokens;
+            """
+        )
+        token_kinds = {i[0]: set(i[1]) for i in cursor.fetchall()}
+        token_kinds[0] = {"nop"}
+
+        c.close()
+
+        lut_size = max(postgresUtil.id2token_map) + 1
+        # Ids missing from the vocab stay -1 and match no kind
+        self.kind_lut = np.full(lut_size, -1, dtype=np.int8)
+        # Tokens that are both a uom and a categorical value, see decode
+        self.uom_or_value_lut = np.zeros(lut_size, dtype=bool)
+        self.bin_lut = np.full(lut_size, -1, dtype=np.int8)
+        self.hour_lut = np.full(lut_size, -1, dtype=np.int8)
+        self.token_lut = np.full(lut_size, None, dtype=object)
+
+        for token_id, token in postgresUtil.id2token_map.items():
+            kinds = token_kinds.get(token_id, set())
+            assert kinds and kinds <= KINDS.keys(), f"Token {token!r} has kinds {kinds}"
+
+            self.token_lut[token_id] = token
+
+            if len(kinds) > 1:
+                assert kinds == {"uom", "value"}, f"Can't decode {token!r} as {kinds}"
+                self.kind_lut[token_id] = KIND_UOM
+                self.uom_or_value_lut[token_id] = True
+                continue
+
+            (kind,) = kinds
+            self.kind_lut[token_id] = KINDS[kind]
+
+            if kind == "hour":
+                self.hour_lut[token_id] = int(token.split(".")[1])
+            elif kind == "magnitude":
+                self.bin_lut[token_id] = int(token.split(".")[1])
+
+    def decode(self, ids, start_hour=None) -> np.ndarray:
+        """
+        Decode a 1d sequence or 2d batch of token ids into an EVENT_DTYPE array
+
+        uom / value are token ids (-1 if absent), bin is the magnitude bin (-1 for
+        categorical or missing values) and hour is the clock hour of the most recent
+        hour token, falling back to start_hour (scalar or per-sequence, default -1)
+        for events before the first one.
+        """
+        ids = np.atleast_2d(np.asarray(ids, dtype=np.int64))
+        n, length = ids.shape
+
+        # Three nop columns so lookahead never runs into the next sequence
+        padded = np.zeros((n, length + 3), dtype=np.int64)
+        padded[:, :length] = ids
+        kind = self.kind_lut[padded]
+
+        seq, pos = np.nonzero(kind[:, :length] == KIND_LABEL)
+
+        # A uom is always followed by a magnitude and a categorical value never is,
+        # which settles tokens that are both
+        has_uom = (kind[seq, pos + 1] == KIND_UOM) & (
+            ~self.uom_or_value_lut[padded[seq, pos + 1]]
+            | (kind[seq, pos + 2] == KIND_MAGNITUDE)
+        )
+        uom = np.where(has_uom, padded[seq, pos + 1], -1)
+
+        value_pos = pos + 1 + has_uom
+        value_ids = padded[seq, value_pos]
+        value_kind = np.where(
+            self.uom_or_value_lut[value_ids], KIND_VALUE, kind[seq, value_pos]
+        )
+        bins = np.where(value_kind == KIND_MAGNITUDE, self.bin_lut[value_ids], -1)
+        values = np.where(value_kind == KIND_VALUE, value_ids, -1)
+
+        # Forward-fill the index of the last hour token at every position
+        hour_at = self.hour_lut[ids]
+        last_hour_idx = np.where(hour_at >= 0, np.arange(length), -1)
+        last_hour_idx = np.maximum.accumulate(last_hour_idx, axis=1)
+        hours = hour_at[np.arange(n)[:, None], np.maximum(last_hour_idx, 0)]
+
+        if start_hour is None:
+            start_hour = -1
+        start_hour = np.broadcast_to(np.asarray(start_hour, dtype=np.int8), (n,))
+        hours = np.where(last_hour_idx >= 0, hours, start_hour[:, None])
+
+        events = np.empty(len(seq), dtype=EVENT_DTYPE)
+        events["seq"] = seq
+        events["pos"] = pos
+        events["label"] = padded[seq, pos]
+        events["uom"] = uom
+        events["bin"] = bins
+        events["value"] = values
+        events["hour"] = hours[seq, pos]
+
+        return events
+
+    def to_strings(self, events: np.ndarray) -> dict:
+        """
+        Token strings for the label / uom / value fields of decoded events (None where
+        absent), as object arrays
+        """
+        lookup = np.append(self.token_lut, None)
+
+        return {
+            k: lookup[np.where(events[k] >= 0, events[k], len(self.token_lut))]
+            for k in ["label", "uom", "value"]
+        }
+
+
+class InferenceEngine:
+    """
+    Builds model inputs for many (stay_id, cutoff time) pairs at once
+
+    Token streams and static features for the whole cohort are fetched with one query
+    each (or read from a TokenStore). Every cutoff is then a slice of its stay's
+    stream: the block_size window before it is gathered with a single fancy index
+    over all prompts, and the history hour count feeding the memory vector comes
+    from a prefix sum shared by all cutoffs of a stay. Output matches what
+    _get_tokens_mem(stay_id, block_size, pad=True, limit=cutoff) builds one by one.
+    """
+
+    def __init__(
+        self,
+        block_size: int,
+        postgresUtil: Optional[PostgresUtil] = None,
+        token_store: Optional[TokenStore] = None,
+    ):
+        self.block_size = block_size
+        self.postgresUtil = postgresUtil if postgresUtil is not None else PostgresUtil()
+        self.token_store = token_store
+
+        self.is_hour_lut = np.zeros(
+            max(self.postgresUtil.id2token_map) + 1, dtype=np.int64
+        )
+        self.is_hour_lut[self.postgresUtil._hourtokens.numpy()] = 1
+
+    def _fetch_streams(self, stay_ids: np.ndarray) -> TokenStore:
+        if self.token_store is not None and all(
+            i in self.token_store for i in stay_ids
+        ):
+            # Copy out just the cohort's slices so everything below is cohort-sized
+            tokens = [self.token_store.get(i) for i in stay_ids]
+            times = [self.token_store.get_times(i) for i in stay_ids]
+            offsets = np.concatenate([[0], np.cumsum([len(i) for i in tokens])])
+
+            return TokenStore(
+                stay_ids,
+                offsets.astype(np.int64),
+                np.concatenate(tokens),
+                np.concatenate(times),
+                fingerprint="",
+            )
+
+        c = psycopg2.connect("")
+        cursor = c.cursor()
+        cursor.execute(
+            """
+            --sql
+            SELECT stay_id, charttime, token_id
+            FROM mimiciv_local.tokenevents
+            WHERE stay_id = ANY(%s)
+            ORDER BY stay_id, charttime, ctid;
+            """,
+            (stay_ids.tolist(),),
+        )
+        res = cursor.fetchall()
+        c.close()
+
+        sids = np.array([i[0] for i in res], dtype=np.int64)
+        times = np.array([i[1] for i in res], dtype="datetime64[us]")
+        tokens = np.array([i[2] for i in res], dtype=np.int32)
+
+        # Stays with no tokens still need an (empty) entry
+        offsets = np.searchsorted(sids, stay_ids).astype(np.int64)
+        offsets = np.append(offsets, len(sids))
+
+        return TokenStore(stay_ids, offsets, tokens, times, fingerprint="")
+
+    def _fetch_static_feats(self, stay_ids: np.ndarray) -> np.ndarray:
+        c = psycopg2.connect("")
+        cursor = c.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cursor.execute(
+            """
+            --sql
+            SELECT * FROM mimiciv_local.staticfeats
+            WHERE stay_id = ANY(%s);
+            """,
+            (stay_ids.tolist(),),
+        )
+        res = {r["stay_id"]: r for r in cursor.fetchall()}
+        c.close()
+
+        assert len(res) == len(stay_ids), "Missing stay_ids in staticfeats"
+
+        return np.stack(
+            [PostgresUtil._normalize_static_feats(res[i]) for i in stay_ids.tolist()]
+        )
+
+    def build_prompts(self, stay_ids, cutoffs, pad: bool = True):
+        """
+        Returns (X, memory) with one row per (stay_id, cutoff) pair, where X holds the
+        last block_size tokens with charttime <= cutoff (left-padded with nop)
+        """
+        stay_ids = np.asarray(stay_ids, dtype=np.int64)
+        cutoffs = np.asarray(cutoffs, dtype="datetime64[us]")
+
+        unique_stays, stay_pos = np.unique(stay_ids, return_inverse=True)
+        store = self._fetch_streams(unique_stays)
+        static_feats = self._fetch_static_feats(unique_stays)
+
+        starts, ends = store.as_of_positions(stay_ids, cutoffs)
+        # Trailing nop so the gather below is valid even if the cohort has no tokens
+        tokens = np.append(store.tokens, 0)
+
+        # Window of block_size tokens ending at each cutoff, nop before stay start
+        window = ends[:, None] - self.block_size + np.arange(self.block_size)
+        valid = window >= starts[:, None]
+        X = np.where(valid, tokens[np.clip(window, 0, None)], 0)
+
+        if not pad:
+            assert np.all(valid), "Unpadded prompts need >= block_size tokens"
+
+        # Hour tokens strictly before the window, from a prefix sum over all tokens
+        hour_prefix = np.concatenate([[0], np.cumsum(self.is_hour_lut[tokens[:-1]])])
+        history_end = np.maximum(window[:, 0], starts)
+        los_hours = hour_prefix[history_end] - hour_prefix[starts]
+        los_hours = np.log(los_hours + 1) / np.log(5434)
+
+        memory = np.empty(
+            (len(stay_ids), self.postgresUtil.memory_size),
+            dtype=self.postgresUtil.np_memory_dtype,
+        )
+        memory[:, :-1] = static_feats[stay_pos]
+        memory[:, -1] = los_hours
+
+        X = X.astype(self.postgresUtil.np_token_dtype)
+
+        return torch.from_numpy(X), torch.from_numpy(memory)
+
+    def build_cohort_prompts(self, cohort_table: str = "overnight_blood"):
+        """
+        Prompts for every row of a mimiciv_local cohort table with (stay_id,
+        shift_starttime) columns, such as overnight_blood. Also returns the raw rows.
+        """
+        c = psycopg2.connect("")
+        cursor = c.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        # NOTE: unsafe sql query construction, only pass trusted table names
+        cursor.execute(
+            f"""
+            --sql
+            SELECT * FROM mimiciv_local.{cohort_table}
+            ORDER BY stay_id, shift_starttime;
+            """
+        )
+        rows = cursor.fetchall()
+        c.close()
+
+        X, memory = self.build_prompts(
+            [r["stay_id"] for r in rows], [r["shift_starttime"] for r in rows]
+        )
+
+        return X, memory, rows
@@ -1,18 +1,37 @@
 from torch.utils.data import Dataset
+from torch.utils.data import default_collate
+from torch.utils.data import get_worker_info
 import psycopg2
 import psycopg2.extras
 import atexit
+import threading
+import copy
+import os
 import torch
 import numpy as np
 import datetime
-from typing import Optional
+from typing import Optional, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from emrgptdata.index import StayIndex
+from emrgptdata.store import TokenStore
+from emrgptdata.shmcache import SharedTokenCache
 
 
 class PostgresUtil:
-    def __init__(self):
+    def __init__(
+        self,
+        token_store: Optional[TokenStore] = None,
+        token_cache: Optional[SharedTokenCache] = None,
+        compact: bool = False,
+    ):
         super().__init__()
         self.conn = None
         self.conn_initialized = False
+        # If set, token streams are served from the store instead of tokenevents
+        self.token_store = token_store
+        # If set, full token streams fetched from tokenevents are shared across workers
+        self.token_cache = token_cache
 
         c = psycopg2.connect("")
         cursor = c.cursor()
@@ -31,6 +50,18 @@ class PostgresUtil:
         self.id2token_map = {**{i[0]: i[1] for i in res}, **{0: "nop"}}
         self.token2id_map = {**{i[1]: i[0] for i in res}, **{"nop": 0}}
         self.vocab_size = len(self.id2token_map)
+
+        # In compact mode tokens are kept in the smallest int type that fits the vocab
+        # and memory vectors in half precision until widen_batch
+        self.compact = compact
+        if compact and max(self.id2token_map) <= np.iinfo(np.int16).max:
+            self.np_token_dtype = np.int16
+        elif compact:
+            self.np_token_dtype = np.int32
+        else:
+            self.np_token_dtype = np.int64
+        self.np_memory_dtype = np.float16 if compact else np.float32
+
         # Precompute so can be used later
         self._hourtokens = torch.tensor(
             [v for k, v in self.token2id_map.items() if k.startswith("hour.")],
@@ -66,7 +97,18 @@ class PostgresUtil:
         if self.conn is not None:
             self.conn.close()
 
-    def _build_memory_vector(self, stay_id: int, history: Optional[torch.Tensor]):
+    def _clone(self):
+        """
+        Shallow copy that shares vocab, store and cache but opens its own connection
+
+        psycopg2 serializes queries on a connection, so each fetch thread needs one.
+        """
+        other = copy.copy(self)
+        other.conn = None
+        other.conn_initialized = False
+        return other
+
+    def _get_static_feats(self, stay_id: int) -> np.ndarray:
         self._lazy_init()
 
         cursor = self.conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)  # type: ignore
@@ -82,7 +124,11 @@ class PostgresUtil:
         res = cursor.fetchall()
         assert len(res) == 1, "Should only be one entry per stay_id in staticfeats"
 
-        static_feats = {k: v for k, v in res[0].items() if k != "stay_id"}
+        return self._normalize_static_feats(res[0])
+
+    @staticmethod
+    def _normalize_static_feats(row: dict) -> np.ndarray:
+        static_feats = {k: v for k, v in row.items() if k != "stay_id"}
         for k, v in static_feats.items():
             if v is None:
                 static_feats[k] = 0.0
@@ -95,6 +141,19 @@ class PostgresUtil:
         static_feats["height"] = static_feats["height"] / 200
         static_feats["weight"] = np.log(static_feats["weight"] + 1) / np.log(635)
 
+        return np.fromiter(
+            static_feats.values(), dtype=np.float64, count=len(static_feats)
+        )
+
+    def _build_memory_vector(
+        self,
+        stay_id: int,
+        history: Optional[torch.Tensor],
+        static_feats: Optional[np.ndarray] = None,
+    ):
+        if static_feats is None:
+            static_feats = self._get_static_feats(stay_id)
+
         los_hours = 0.0
         if history is not None:
 
@@ -103,16 +162,29 @@ class PostgresUtil:
             # Also log-normalizing los-icu
             los_hours = np.log(los_hours + 1) / np.log(5434)
 
-        memory = torch.tensor(
-            list(static_feats.values()) + [los_hours], dtype=torch.float
-        )
+        assert len(static_feats) + 1 == self.memory_size
+        memory = np.empty(self.memory_size, dtype=self.np_memory_dtype)
+        memory[:-1] = static_feats
+        memory[-1] = los_hours
 
-        assert len(memory) == self.memory_size
-        return memory
+        return torch.from_numpy(memory)
 
     def _get_token_stream(
         self, stay_id: int, limit: Optional[datetime.datetime] = None
     ):
+        if self.token_store is not None and stay_id in self.token_store:
+            if limit:
+                token_stream = self.token_store.as_of(stay_id, limit)
+            else:
+                token_stream = self.token_store.get(stay_id)
+
+            return torch.from_numpy(np.array(token_stream, dtype=self.np_token_dtype))
+
+        if self.token_cache is not None and not limit:
+            cached = self.token_cache.get(stay_id)
+            if cached is not None:
+                return torch.from_numpy(cached)
+
         self._lazy_init()
         cursor = self.conn.cursor()  # type: ignore
 
@@ -141,7 +213,13 @@ class PostgresUtil:
             )
 
         res = cursor.fetchall()
-        token_stream = torch.tensor(res, dtype=torch.long).flatten()
+        token_stream = torch.from_numpy(
+            np.array(res, dtype=self.np_token_dtype).reshape(-1)
+        )
+
+        if self.token_cache is not None and not limit:
+            self.token_cache.put(stay_id, token_stream.numpy())
+
         return token_stream
 
     def _get_tokens_mem(
@@ -177,29 +255,54 @@ class PostgresUtil:
 
 class TokenStreamDS(Dataset):
 
-    def __init__(self, block_size: int, testset: bool = False):
+    def __init__(
+        self,
+        block_size: int,
+        testset: bool = False,
+        cache_dir: Optional[str] = None,
+        verify_index: bool = True,
+        use_token_store: bool = False,
+        shared_cache_bytes: int = 0,
+        prefetch: int = 0,
+        prefetch_threads: int = 4,
+        compact: bool = False,
+    ):
         super().__init__()
-        self.postgresUtil = PostgresUtil()
 
-        self.block_size = block_size
+        token_store = None
+        if use_token_store:
+            token_store = TokenStore.load_or_build(testset, cache_dir, verify_index)
 
-        c = psycopg2.connect("")
-        cursor = c.cursor()
+        self.postgresUtil = PostgresUtil(token_store, compact=compact)
 
-        # Get stay ids
-        cursor.execute(
-            """
-            --sql
-            SELECT stay_id FROM mimiciv_local.splits
-            WHERE testset = %s;
-            """,
-            ("true" if testset else "false",),
-        )
+        self.block_size = block_size
+        self.testset = testset
+        self._shard_range = None
 
-        res = cursor.fetchall()
-        self.stay_ids = [i[0] for i in res]
+        # Need at least 3 tokens to draw a truncation point in __getitem__
+        self.index = StayIndex.load_or_build(testset, cache_dir, verify_index).filter(
+            min_length=3
+        )
+        self.stay_ids = self.index.stay_ids
+
+        # Named by split and table build, so every rank on the node (and all of their
+        # workers) attaches to the same cache
+        if shared_cache_bytes > 0:
+            token_dtype = np.dtype(self.postgresUtil.np_token_dtype)
+            self.postgresUtil.token_cache = SharedTokenCache(
+                f"{'test' if testset else 'train'}_{self.index.fingerprint}_"
+                f"{token_dtype.name}",
+                shared_cache_bytes,
+                dtype=token_dtype,
+            )
 
-        c.close()
+        # Number of samples to fetch ahead of consumption in __getitems__ and
+        # iter_prefetched. 0 disables prefetching.
+        self.prefetch = prefetch
+        self.prefetch_threads = prefetch_threads
+        self._executor = None
+        self._executor_pid = None
+        self._thread_local = None
 
         print("Initiated dataset with:")
         print(f"\tICU stays: {len(self.stay_ids)}")
@@ -209,10 +312,94 @@ class TokenStreamDS(Dataset):
     def __len__(self):
         return len(self.stay_ids)
 
+    def load_shard_store(self, sampler):
+        """
+        Serve this rank's shard (e.g. from a LengthBalancedShardSampler, after
+        set_epoch) from memory, loaded with one sequential range scan of tokenevents
+
+        Only takes effect in DataLoader workers created after this call: workers copy
+        the dataset when they start, so with persistent_workers=True they keep the
+        first epoch's shard and silently fall back to per-stay queries for the rest.
+        Use persistent_workers=False (or a new DataLoader each epoch) with this.
+        The store is only rebuilt when the shard's stay range changes.
+        """
+        assert get_worker_info() is None, "Call load_shard_store from the main process"
+
+        stay_range = sampler.stay_range()
+        if self._shard_range == stay_range:
+            return
+
+        self.postgresUtil.token_store = TokenStore.build(
+            self.testset, stay_range=stay_range
+        )
+        self._shard_range = stay_range
+
+    def __getstate__(self):
+        # Thread pools don't survive pickling or fork, workers make their own
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        state["_executor_pid"] = None
+        state["_thread_local"] = None
+        return state
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._thread_local = threading.local()
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.prefetch_threads,
+                initializer=self._init_fetch_thread,
+            )
+            self._executor_pid = os.getpid()
+
+        return self._executor
+
+    def _init_fetch_thread(self):
+        self._thread_local.postgresUtil = self.postgresUtil._clone()
+
+    def _fetch(self, index, postgresUtil: Optional[PostgresUtil] = None):
+        """
+        All the I/O for a sample: the token stream and static features
+        """
+        if postgresUtil is None:
+            postgresUtil = self._thread_local.postgresUtil
+
+        stay_id = int(self.stay_ids[index])
+        token_stream = postgresUtil._get_token_stream(stay_id)
+        static_feats = postgresUtil._get_static_feats(stay_id)
+
+        return stay_id, token_stream, static_feats
+
+    def iter_prefetched(self, indices: Iterable[int]):
+        """
+        Yield samples for indices (e.g. iter(sampler)) in order, keeping up to
+        self.prefetch fetches in flight on a thread pool so DB latency overlaps with
+        sample construction
+        """
+        if self.prefetch <= 0:
+            for index in indices:
+                yield self[index]
+            return
+
+        executor = self._get_executor()
+        pending = deque()
+
+        for index in indices:
+            pending.append(executor.submit(self._fetch, index))
+
+            if len(pending) >= self.prefetch:
+                yield self._build_sample(*pending.popleft().result())
+
+        while pending:
+            yield self._build_sample(*pending.popleft().result())
+
+    def __getitems__(self, indices: list):
+        # DataLoader hands each worker a whole batch of indices at once
+        return list(self.iter_prefetched(indices))
+
     def __getitem__(self, index):
-        stay_id = self.stay_ids[index]
-        token_stream = self.postgresUtil._get_token_stream(stay_id)
+        return self._build_sample(*self._fetch(index, self.postgresUtil))
 
+    def _build_sample(self, stay_id: int, token_stream: torch.Tensor, static_feats):
         truncation_idx = torch.randint(1, len(token_stream) - 1, (1,)).item()
         start_idx = max(0, truncation_idx - self.block_size)
         X = token_stream[start_idx:truncation_idx]
@@ -228,7 +415,7 @@ class TokenStreamDS(Dataset):
         if len(y) < self.block_size + 1:
             y = torch.nn.functional.pad(y, ((self.block_size + 1) - len(y), 0))
 
-        memory = self.postgresUtil._build_memory_vector(stay_id, history)
+        memory = self.postgresUtil._build_memory_vector(stay_id, history, static_feats)
 
         assert len(X) == self.block_size
         assert len(y) == self.block_size + 1
@@ -237,6 +424,25 @@ class TokenStreamDS(Dataset):
         return X, memory, y
 
 
+def widen_batch(batch):
+    """
+    Convert a (X, memory, y) batch from a compact TokenStreamDS to long / float
+
+    Call this on the batch coming out of the DataLoader (ideally after .to(device)),
+    so workers, IPC and pinned buffers only ever handle the compact tensors.
+    """
+    X, memory, y = batch
+    return X.long(), memory.float(), y.long()
+
+
+def widen_collate(batch):
+    """
+    Drop-in collate_fn that widens immediately, for callers that want long / float
+    tensors out of the DataLoader but still compact storage in caches
+    """
+    return widen_batch(default_collate(batch))
+
+
 if __name__ == "__main__":
     ds = TokenStreamDS(block_size=256)
 
@@ -0,0 +1,139 @@
+from torch.utils.data import Sampler
+import torch.distributed as dist
+import numpy as np
+import math
+from typing import Optional
+
+
+def balanced_shard_bounds(lengths: np.ndarray, num_shards: int) -> np.ndarray:
+    """
+    Split 0..len(lengths) into num_shards contiguous ranges of about equal total length
+
+    Returns num_shards + 1 boundaries, shard k is [bounds[k], bounds[k + 1]). A shard's
+    total is within one stay length of the target (half from each boundary), as long
+    as the stays are numerous enough that no shard has to be forced non-empty.
+    """
+    assert len(lengths) >= num_shards, "Need at least one stay per shard"
+
+    cumulative = np.cumsum(lengths)
+    targets = cumulative[-1] * np.arange(1, num_shards) / num_shards
+
+    # Cut before or after the stay that crosses each target, whichever lands closer,
+    # so each boundary misses its target by at most half of one stay
+    crossing = np.searchsorted(cumulative, targets, side="left")
+    before = np.where(crossing > 0, cumulative[crossing - 1], 0)
+    inner = crossing + (cumulative[crossing] - targets < targets - before)
+
+    # Guarantee every shard gets at least one stay: shifting boundary k down by k
+    # turns "strictly increasing and within [k, n - num_shards + k]" into a
+    # non-decreasing clip to [1, n - num_shards + 1]
+    shift = np.arange(num_shards - 1)
+    inner = np.clip(inner - shift, 1, len(lengths) - num_shards + 1)
+    inner = np.maximum.accumulate(inner) + shift
+
+    return np.concatenate([[0], inner, [len(lengths)]]).astype(np.int64)
+
+
+class LengthBalancedShardSampler(Sampler):
+    """
+    Rank-aware replacement for DistributedSampler over a TokenStreamDS
+
+    The dataset (sorted by stay_id) is cut into num_replicas contiguous shards with
+    about the same number of tokens each, using the per-stay lengths from the stay
+    index, so every rank does about the same amount of fetching per epoch and only
+    ever reads one contiguous stay_id range (see TokenStreamDS.load_shard_store).
+
+    Each epoch the shard -> rank assignment is permuted with seed + epoch, and within
+    a shard chunks of chunk_size consecutive stays are visited in shuffled order (but
+    in stay_id order inside each chunk) to keep reads sequential.
+
+    Like DistributedSampler, every rank yields the same number of indices, which
+    token balancing can't also guarantee: a shard of fewer, longer stays has fewer
+    indices. By default such shards are padded with their own shortest stays (cycled
+    if needed), which keeps the extra tokens small but oversamples short stays on
+    that rank. With drop_last=True longer shards are truncated instead, so nothing is
+    oversampled but some stays are skipped each epoch.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        shuffle: bool = True,
+        seed: int = 0,
+        drop_last: bool = False,
+        chunk_size: int = 64,
+    ):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_initialized() else 0
+
+        assert 0 <= rank < num_replicas, f"Invalid rank {rank}"
+
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.chunk_size = chunk_size
+        self.epoch = 0
+
+        self.bounds = balanced_shard_bounds(dataset.index.lengths, num_replicas)
+        shard_sizes = np.diff(self.bounds)
+
+        if drop_last:
+            self.num_samples = int(shard_sizes.min())
+        else:
+            self.num_samples = int(shard_sizes.max())
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def shard(self) -> int:
+        """
+        Which shard this rank reads in the current epoch
+        """
+        if not self.shuffle:
+            return self.rank
+
+        rng = np.random.default_rng(self.seed + self.epoch)
+        return int(rng.permutation(self.num_replicas)[self.rank])
+
+    def index_range(self) -> tuple[int, int]:
+        shard = self.shard()
+        return int(self.bounds[shard]), int(self.bounds[shard + 1])
+
+    def stay_range(self) -> tuple[int, int]:
+        """
+        Inclusive (first, last) stay_id of this rank's shard in the current epoch
+        """
+        lo, hi = self.index_range()
+        return int(self.dataset.stay_ids[lo]), int(self.dataset.stay_ids[hi - 1])
+
+    def __iter__(self):
+        lo, hi = self.index_range()
+        indices = np.arange(lo, hi)
+
+        if self.shuffle:
+            # Different stream from the shard assignment so ranks don't correlate
+            rng = np.random.default_rng((self.seed, self.epoch, self.rank))
+            chunks = np.array_split(indices, math.ceil(len(indices) / self.chunk_size))
+            indices = np.concatenate([chunks[i] for i in rng.permutation(len(chunks))])
+
+        if len(indices) < self.num_samples:
+            # Pad with the shortest stays, adding as few tokens as possible
+            by_length = lo + np.argsort(
+                self.dataset.index.lengths[lo:hi], kind="stable"
+            )
+            padding = np.resize(by_length, self.num_samples - len(indices))
+            indices = np.concatenate([indices, padding])
+        else:
+            indices = indices[: self.num_samples]
+
+        return iter(indices.tolist())
+
+    def __len__(self):
+        return self.num_samples
@@ -0,0 +1,321 @@
+import numpy as np
+import os
+import mmap
+import fcntl
+import atexit
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+
+def default_shm_dir() -> str:
+    return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+class SharedTokenCache:
+    """
+    Token stream cache shared by every process on a node that opens the same name
+
+    The cache is a single file in /dev/shm, mapped by every process that uses it: all
+    DDP ranks on the node and all of their DataLoader workers. The first process to
+    open a name creates and sizes it, later ones attach and use the creator's
+    budget. The last process to close it removes the file (a crashed job leaves it
+    behind in /dev/shm).
+
+    Layout: a header, an open-addressed hash table (stay_id -> offset, nbytes), a
+    FIFO ring of stay_ids in insertion order, and the arena the streams are written
+    into back to back as a ring buffer. Because the arena is written in insertion
+    order, the space the write head moves into always belongs to the oldest entries,
+    so every eviction (arena space or entry count) pops the FIFO tail. Reads and
+    writes hold an flock on the file, and a slot's key is only written after its
+    data, so readers never see partial entries.
+    """
+
+    # Header fields, in int64s
+    (
+        MAGIC,
+        WRITE_HEAD,
+        BUDGET,
+        MAX_ENTRIES,
+        ITEMSIZE,
+        REFCOUNT,
+        FIFO_START,
+        FIFO_COUNT,
+    ) = range(8)
+    HEADER_SIZE = 8
+    MAGIC_VALUE = 0x454D5247505443  # "EMRGPTC"
+
+    # Hash table columns
+    KEY, OFFSET, NBYTES = range(3)
+    EMPTY = -1
+
+    def __init__(
+        self,
+        name: str,
+        budget_bytes: int,
+        max_entries: int = 65536,
+        dtype=np.int64,
+        shm_dir: Optional[str] = None,
+    ) -> None:
+        self.path = os.path.join(shm_dir or default_shm_dir(), f"emrgpt_cache_{name}")
+        self.dtype = np.dtype(dtype)
+        self._open(budget_bytes, max_entries)
+
+    def __getstate__(self):
+        return {"path": self.path, "dtype": self.dtype}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self.dtype = state["dtype"]
+        self._open()
+
+    @staticmethod
+    def _capacity(max_entries: int) -> int:
+        # Power of 2, at most half full
+        return 1 << (2 * max_entries - 1).bit_length()
+
+    def _open(self, budget_bytes: int = 0, max_entries: int = 0):
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+
+            # Lost a race with the last user removing the file, try again
+            if os.fstat(fd).st_nlink > 0:
+                break
+
+            os.close(fd)
+
+        try:
+            created = os.fstat(fd).st_size == 0
+            if created and budget_bytes <= 0:
+                os.remove(self.path)
+                raise FileNotFoundError(f"No cache at {self.path} to attach to")
+
+            if created:
+                size = self._layout(budget_bytes, max_entries)
+                os.ftruncate(fd, size)
+                self._map(fd, size)
+
+                self.header[:] = 0
+                self.header[self.BUDGET] = budget_bytes
+                self.header[self.MAX_ENTRIES] = max_entries
+                self.header[self.ITEMSIZE] = self.dtype.itemsize
+                self.table[:, self.KEY] = self.EMPTY
+                self.header[self.MAGIC] = self.MAGIC_VALUE
+            else:
+                header = np.frombuffer(
+                    os.pread(fd, self.HEADER_SIZE * 8, 0), dtype=np.int64
+                )
+                assert header[self.MAGIC] == self.MAGIC_VALUE, f"Bad cache {self.path}"
+                assert header[self.ITEMSIZE] == self.dtype.itemsize
+                size = self._layout(
+                    int(header[self.BUDGET]), int(header[self.MAX_ENTRIES])
+                )
+                self._map(fd, size)
+
+                if budget_bytes and budget_bytes != self.budget_bytes:
+                    print(
+                        f"Attached to existing cache {self.path} "
+                        f"with budget {self.budget_bytes} bytes"
+                    )
+
+            self.header[self.REFCOUNT] += 1
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+        self._fd = fd
+        self._pid = os.getpid()
+        self._thread_lock = threading.Lock()
+        atexit.register(self._teardown)
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _layout(self, budget_bytes: int, max_entries: int) -> int:
+        self.budget_bytes = budget_bytes
+        self.max_entries = max_entries
+        self.capacity = self._capacity(max_entries)
+        self._hash_shift = 64 - (self.capacity.bit_length() - 1)
+
+        self._table_offset = self.HEADER_SIZE * 8
+        self._fifo_offset = self._table_offset + self.capacity * 3 * 8
+        self._arena_offset = self._fifo_offset + max_entries * 8
+
+        return self._arena_offset + budget_bytes
+
+    def _map(self, fd: int, size: int):
+        self._mmap = mmap.mmap(fd, size)
+        self.header = np.ndarray((self.HEADER_SIZE,), dtype=np.int64, buffer=self._mmap)
+        self.table = np.ndarray(
+            (self.capacity, 3),
+            dtype=np.int64,
+            buffer=self._mmap,
+            offset=self._table_offset,
+        )
+        self.fifo = np.ndarray(
+            (self.max_entries,),
+            dtype=np.int64,
+            buffer=self._mmap,
+            offset=self._fifo_offset,
+        )
+        self.arena = np.ndarray(
+            (self.budget_bytes,),
+            dtype=np.uint8,
+            buffer=self._mmap,
+            offset=self._arena_offset,
+        )
+
+    def _after_fork(self):
+        # flock doesn't exclude processes sharing an inherited fd, so forked children
+        # open their own. This runs before the child has any other threads, and the
+        # parent's thread lock may have been held by a thread that no longer exists.
+        if self._fd is None:
+            return
+
+        inherited = self._fd
+        self._fd = os.open(self.path, os.O_RDWR)
+        self._thread_lock = threading.Lock()
+        os.close(inherited)
+
+    @contextmanager
+    def _lock(self):
+        with self._thread_lock:
+            # Unlock the fd that was locked, whatever happens to self._fd meanwhile
+            fd = self._fd
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _teardown(self):
+        # Forked children that never attached don't hold a reference
+        if self._pid != os.getpid() or self._fd is None:
+            return
+
+        with self._lock():
+            self.header[self.REFCOUNT] -= 1
+            if self.header[self.REFCOUNT] <= 0:
+                os.remove(self.path)
+
+        os.close(self._fd)
+        self._fd = None
+
+    def _hash(self, stay_id: int) -> int:
+        # Fibonacci hashing: top bits of a 64-bit multiplicative hash
+        return ((stay_id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> self._hash_shift
+
+    def _find(self, stay_id: int) -> int:
+        """
+        Slot holding stay_id, or the empty slot where it would go
+        """
+        mask = self.capacity - 1
+        slot = self._hash(stay_id)
+
+        while True:
+            key = self.table[slot, self.KEY]
+            if key == stay_id or key == self.EMPTY:
+                return slot
+            slot = (slot + 1) & mask
+
+    def _remove(self, stay_id: int):
+        """
+        Delete by backward shift, so lookups never need tombstones
+        """
+        mask = self.capacity - 1
+        hole = self._find(stay_id)
+        assert self.table[hole, self.KEY] == stay_id
+
+        slot = hole
+        while True:
+            slot = (slot + 1) & mask
+            key = int(self.table[slot, self.KEY])
+            if key == self.EMPTY:
+                break
+
+            home = self._hash(key)
+            # Move the entry back into the hole unless its home lies in (hole, slot]
+            if (slot - home) & mask >= (slot - hole) & mask:
+                self.table[hole] = self.table[slot]
+                hole = slot
+
+        self.table[hole, self.KEY] = self.EMPTY
+
+    def _evict_oldest(self):
+        start = int(self.header[self.FIFO_START])
+        self._remove(int(self.fifo[start]))
+        self.header[self.FIFO_START] = (start + 1) % self.max_entries
+        self.header[self.FIFO_COUNT] -= 1
+
+    def _oldest_offset(self) -> Optional[int]:
+        if self.header[self.FIFO_COUNT] == 0:
+            return None
+
+        oldest = int(self.fifo[self.header[self.FIFO_START]])
+        return int(self.table[self._find(oldest), self.OFFSET])
+
+    def get(self, stay_id: int) -> Optional[np.ndarray]:
+        stay_id = int(stay_id)
+
+        with self._lock():
+            slot = self._find(stay_id)
+            if self.table[slot, self.KEY] == self.EMPTY:
+                return None
+
+            offset = int(self.table[slot, self.OFFSET])
+            nbytes = int(self.table[slot, self.NBYTES])
+            return self.arena[offset : offset + nbytes].view(self.dtype).copy()
+
+    def put(self, stay_id: int, token_stream) -> bool:
+        """
+        Insert a stream, evicting the oldest entries as needed
+
+        Returns False if the stream is larger than the whole arena and wasn't cached.
+        """
+        stay_id = int(stay_id)
+        data = np.ascontiguousarray(token_stream, dtype=self.dtype)
+        nbytes = data.nbytes
+
+        if nbytes > self.budget_bytes:
+            return False
+
+        with self._lock():
+            if self.table[self._find(stay_id), self.KEY] == stay_id:
+                return True
+
+            head = int(self.header[self.WRITE_HEAD])
+
+            # Wrapping abandons the tail of the arena, which holds the oldest entries
+            if head + nbytes > self.budget_bytes:
+                while (offset := self._oldest_offset()) is not None and offset >= head:
+                    self._evict_oldest()
+                head = 0
+
+            # Entries in the space we're about to write are the oldest ones left
+            while (offset := self._oldest_offset()) is not None and (
+                head <= offset < head + nbytes
+            ):
+                self._evict_oldest()
+
+            if self.header[self.FIFO_COUNT] == self.max_entries:
+                self._evict_oldest()
+
+            self.arena[head : head + nbytes] = data.view(np.uint8)
+
+            slot = self._find(stay_id)
+            self.table[slot, self.OFFSET] = head
+            self.table[slot, self.NBYTES] = nbytes
+            # Publish last
+            self.table[slot, self.KEY] = stay_id
+
+            tail = (self.header[self.FIFO_START] + self.header[self.FIFO_COUNT]) % (
+                self.max_entries
+            )
+            self.fifo[tail] = stay_id
+            self.header[self.FIFO_COUNT] += 1
+            self.header[self.WRITE_HEAD] = head + nbytes
+
+        return True
+
+    def __len__(self):
+        with self._lock():
+            return int(self.header[self.FIFO_COUNT])
@@ -0,0 +1,307 @@
+import psycopg2
+import numpy as np
+import os
+import json
+import datetime
+from typing import Optional
+from emrgptdata.index import default_cache_dir, db_fingerprint
+
+
+class TokenStore:
+    """
+    Flat on-disk copy of tokenevents for one split, with a per-stay time index
+
+    Tokens for all stays are concatenated in (stay_id, charttime) order. offsets[i] is
+    where stay_ids[i] starts and charttimes is aligned 1:1 with tokens, so any time
+    window is two binary searches over a slice. Arrays are memory-mapped on load.
+    """
+
+    arrays = ["stay_ids", "offsets", "tokens", "charttimes"]
+
+    def __init__(
+        self,
+        stay_ids: np.ndarray,
+        offsets: np.ndarray,
+        tokens: np.ndarray,
+        charttimes: np.ndarray,
+        fingerprint: str,
+    ):
+        assert len(offsets) == len(stay_ids) + 1
+        assert len(tokens) == len(charttimes)
+
+        self.stay_ids = stay_ids
+        self.offsets = offsets
+        self.tokens = tokens
+        self.charttimes = charttimes
+        self.fingerprint = fingerprint
+        # Set by load(mmap=True), so pickling can re-open the files instead of copying
+        self.path = None
+
+    def __getstate__(self):
+        if self.path is None:
+            return self.__dict__
+
+        # Keep DataLoader workers (spawn / forkserver) on the shared page cache
+        return {"path": self.path, "fingerprint": self.fingerprint}
+
+    def __setstate__(self, state):
+        if "path" not in state or state["path"] is None:
+            self.__dict__.update(state)
+            return
+
+        store = TokenStore.load(state["path"], mmap=True)
+        assert (
+            store.fingerprint == state["fingerprint"]
+        ), f"Token store at {state['path']} was rebuilt while in use"
+
+        self.__dict__.update(store.__dict__)
+
+    def __len__(self):
+        return len(self.stay_ids)
+
+    def __contains__(self, stay_id: int):
+        pos = np.searchsorted(self.stay_ids, stay_id)
+        return pos < len(self.stay_ids) and self.stay_ids[pos] == stay_id
+
+    def _bounds(self, stay_id: int):
+        pos = np.searchsorted(self.stay_ids, stay_id)
+        assert (
+            pos < len(self.stay_ids) and self.stay_ids[pos] == stay_id
+        ), f"stay_id {stay_id} not in token store"
+
+        return int(self.offsets[pos]), int(self.offsets[pos + 1])
+
+    @staticmethod
+    def _to_dt64(t) -> np.datetime64:
+        return np.datetime64(t, "us")
+
+    def get(self, stay_id: int) -> np.ndarray:
+        lo, hi = self._bounds(stay_id)
+        return self.tokens[lo:hi]
+
+    def get_times(self, stay_id: int) -> np.ndarray:
+        lo, hi = self._bounds(stay_id)
+        return self.charttimes[lo:hi]
+
+    def window(
+        self,
+        stay_id: int,
+        start: Optional[datetime.datetime] = None,
+        end: Optional[datetime.datetime] = None,
+    ) -> np.ndarray:
+        """
+        Tokens with start <= charttime < end. Either bound may be None (unbounded).
+        """
+        lo, hi = self._bounds(stay_id)
+        times = self.charttimes[lo:hi]
+
+        i, j = 0, hi - lo
+        if start is not None:
+            i = np.searchsorted(times, self._to_dt64(start), "left")
+        if end is not None:
+            j = np.searchsorted(times, self._to_dt64(end), "left")
+
+        return self.tokens[lo + i : lo + max(i, j)]
+
+    def as_of(self, stay_id: int, t: datetime.datetime) -> np.ndarray:
+        """
+        Tokens with charttime <= t. Same semantics as the limit in _get_token_stream.
+        """
+        lo, hi = self._bounds(stay_id)
+        j = np.searchsorted(self.charttimes[lo:hi], self._to_dt64(t), "right")
+
+        return self.tokens[lo : lo + j]
+
+    def last_hours(
+        self, stay_id: int, hours: float, end: Optional[datetime.datetime] = None
+    ) -> np.ndarray:
+        """
+        Tokens in the `hours` leading up to and including `end` (default: end of stay)
+        """
+        lo, hi = self._bounds(stay_id)
+        times = self.charttimes[lo:hi]
+
+        if len(times) == 0:
+            return self.tokens[lo:lo]
+
+        end_dt = times[-1] if end is None else self._to_dt64(end)
+        start_dt = end_dt - np.timedelta64(int(hours * 3600 * 1e6), "us")
+
+        i = np.searchsorted(times, start_dt, "right")
+        j = np.searchsorted(times, end_dt, "right")
+
+        return self.tokens[lo + i : lo + max(i, j)]
+
+    def as_of_positions(self, stay_ids, times) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Batched as_of: returns absolute (start, end) offsets into self.tokens for each
+        (stay_id, time) pair, so that tokens[start:end] is the stream as of that time.
+
+        This is a binary search run on all queries at once, each within its own stay's
+        slice, so it costs O(queries * log(stay length)) in a handful of numpy ops.
+        """
+        stay_ids = np.asarray(stay_ids)
+        times = np.asarray(times, dtype="datetime64[us]")
+        assert stay_ids.shape == times.shape
+
+        pos = np.searchsorted(self.stay_ids, stay_ids)
+        assert np.all(pos < len(self.stay_ids)), "Unknown stay_id"
+        assert np.all(self.stay_ids[pos] == stay_ids), "Unknown stay_id"
+
+        starts = self.offsets[pos]
+
+        # Find the first index in [lo, hi) with charttime > t, i.e. side="right"
+        lo = starts.copy()
+        hi = self.offsets[pos + 1].copy()
+        active = lo < hi
+        while np.any(active):
+            mid = (lo + hi) // 2
+            go_right = active & (self.charttimes[np.where(active, mid, 0)] <= times)
+            lo = np.where(go_right, mid + 1, lo)
+            hi = np.where(active & ~go_right, mid, hi)
+            active = lo < hi
+
+        return starts, lo
+
+    def batch_as_of(self, stay_ids, times) -> list[np.ndarray]:
+        starts, ends = self.as_of_positions(stay_ids, times)
+        return [self.tokens[s:e] for s, e in zip(starts, ends)]
+
+    @staticmethod
+    def _dir(cache_dir: str, testset: bool) -> str:
+        return os.path.join(cache_dir, f"tokenstore_{'test' if testset else 'train'}")
+
+    @classmethod
+    def build(
+        cls,
+        testset: bool = False,
+        batch_size: int = 1_000_000,
+        stay_range: Optional[tuple[int, int]] = None,
+    ) -> "TokenStore":
+        """
+        Dump tokenevents for a split, optionally only stay_ids in [lo, hi]
+
+        A stay_range turns the dump into one sequential range scan of the
+        (stay_id, charttime) index, which is how sharded ranks load their stays.
+        """
+        c = psycopg2.connect("")
+        fingerprint = db_fingerprint(c.cursor())
+
+        # Named (server-side) cursor so the full split is streamed, not held in memory
+        # twice. ctid breaks charttime ties in physical order, which is the order
+        # _get_token_stream returns them in.
+        cursor = c.cursor(name="tokenstore_build")
+        cursor.itersize = batch_size
+
+        if stay_range:
+            cursor.execute(
+                """
+                --sql
+                SELECT t.stay_id, t.charttime, t.token_id
+                FROM mimiciv_local.tokenevents t
+                JOIN mimiciv_local.splits s ON s.stay_id = t.stay_id
+                WHERE s.testset = %s AND t.stay_id BETWEEN %s AND %s
+                ORDER BY t.stay_id, t.charttime, t.ctid;
+                """,
+                ("true" if testset else "false", *stay_range),
+            )
+        else:
+            cursor.execute(
+                """
+                --sql
+                SELECT t.stay_id, t.charttime, t.token_id
+                FROM mimiciv_local.tokenevents t
+                JOIN mimiciv_local.splits s ON s.stay_id = t.stay_id
+                WHERE s.testset = %s
+                ORDER BY t.stay_id, t.charttime, t.ctid;
+                """,
+                ("true" if testset else "false",),
+            )
+
+        sids, times, tokens = list(), list(), list()
+        while True:
+            res = cursor.fetchmany(batch_size)
+            if not res:
+                break
+
+            sids.append(np.array([i[0] for i in res], dtype=np.int64))
+            times.append(np.array([i[1] for i in res], dtype="datetime64[us]"))
+            tokens.append(np.array([i[2] for i in res], dtype=np.int32))
+
+        c.close()
+
+        sids = np.concatenate(sids) if sids else np.zeros(0, dtype=np.int64)
+        times = np.concatenate(times) if times else np.zeros(0, dtype="datetime64[us]")
+        tokens = np.concatenate(tokens) if tokens else np.zeros(0, dtype=np.int32)
+
+        stay_ids, starts = np.unique(sids, return_index=True)
+        offsets = np.append(starts, len(sids)).astype(np.int64)
+
+        return cls(stay_ids, offsets, tokens, times, fingerprint)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "TokenStore":
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+
+        arrays = {
+            k: np.load(os.path.join(path, f"{k}.npy"), mmap_mode="r" if mmap else None)
+            for k in cls.arrays
+        }
+
+        store = cls(**arrays, fingerprint=meta["fingerprint"])
+        if mmap:
+            store.path = path
+
+        return store
+
+    def save(self, path: str):
+        # Write into a scratch dir and swap it in so readers never see a partial store
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+
+        for k in self.arrays:
+            np.save(os.path.join(tmp_path, f"{k}.npy"), getattr(self, k))
+
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"fingerprint": self.fingerprint}, f)
+
+        if os.path.exists(path):
+            old_path = f"{path}.{os.getpid()}.old"
+            os.replace(path, old_path)
+            os.replace(tmp_path, path)
+            for k in os.listdir(old_path):
+                os.remove(os.path.join(old_path, k))
+            os.rmdir(old_path)
+        else:
+            os.replace(tmp_path, path)
+
+    @classmethod
+    def load_or_build(
+        cls,
+        testset: bool = False,
+        cache_dir: Optional[str] = None,
+        verify: bool = True,
+    ) -> "TokenStore":
+        path = cls._dir(cache_dir or default_cache_dir(), testset)
+
+        if os.path.exists(os.path.join(path, "meta.json")):
+            store = cls.load(path)
+
+            if not verify:
+                return store
+
+            c = psycopg2.connect("")
+            fingerprint = db_fingerprint(c.cursor())
+            c.close()
+
+            if store.fingerprint == fingerprint:
+                return store
+
+            print(f"Token store at {path} is stale, rebuilding")
+
+        print(f"Building token store at {path}, this may take a while")
+        store = cls.build(testset)
+        store.save(path)
+
+        return cls.load(path)
@@ -0,0 +1,118 @@
+import datetime
+import uuid
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+
+
+HOUR_TOKENS = {i + 1: f"hour.{i}" for i in range(24)}
+VOCAB = {
+    **HOUR_TOKENS,
+    25: "chemistry.glucose",
+    **{26 + i: f"magnitude.{i}" for i in range(11)},
+    37: "Heparin Sodium",
+    # Both the unit of Heparin doses and a categorical value of bg.specimen
+    38: "mL",
+    39: "bg.specimen",
+    40: "admission",
+}
+TOKEN_KINDS = {
+    **{i: ["hour"] for i in HOUR_TOKENS},
+    25: ["label"],
+    **{26 + i: ["magnitude"] for i in range(11)},
+    37: ["label"],
+    38: ["uom", "value"],
+    39: ["label"],
+    40: ["label"],
+}
+
+
+def fake_stream(stay_id: int) -> list[int]:
+    """
+    Deterministic token stream for a stay: hour tokens followed by glucose events
+    """
+    return [1 + (stay_id + i) % 24 if i % 3 == 0 else 25 + i % 3 for i in range(30)]
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self.rows = list()
+
+    def execute(self, sql, params=()):
+        start = datetime.datetime(2150, 1, 1)
+
+        if "regclass::oid" in sql:
+            self.rows = [self.db.fingerprint]
+        elif "SELECT token_id, token FROM mimiciv_local.d_tokens" in sql:
+            self.rows = list(VOCAB.items())
+        elif "SELECT token_id, token_kinds FROM mimiciv_local.d_tokens" in sql:
+            self.rows = list(TOKEN_KINDS.items())
+        elif "information_schema.columns" in sql and "'d_tokens'" in sql:
+            self.rows = [(1 if self.db.token_kinds else 0,)]
+        elif "information_schema.columns" in sql:
+            self.rows = [(4,)]
+        elif "FROM mimiciv_local.staticfeats" in sql:
+            self.rows = [
+                {
+                    "stay_id": params[0],
+                    "age": 60,
+                    "gender": "F",
+                    "height": 170,
+                    "weight": 80,
+                }
+            ]
+        elif "FROM mimiciv_local.splits" in sql:
+            self.rows = [
+                (
+                    stay_id,
+                    len(fake_stream(stay_id)),
+                    10,
+                    start,
+                    start + datetime.timedelta(hours=10),
+                )
+                for stay_id in self.db.stay_ids
+            ]
+        elif "FROM mimiciv_local.tokenevents" in sql:
+            self.rows = [(i,) for i in fake_stream(params[0])]
+        else:
+            raise NotImplementedError(sql)
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self, cursor_factory=None, name=None):
+        return FakeCursor(self.db)
+
+    def close(self):
+        pass
+
+
+class FakeDB:
+    def __init__(self, stay_ids):
+        self.stay_ids = stay_ids
+        # Unique per test, so shared caches named after it never collide
+        self.fingerprint = (uuid.uuid4().int % 10**8, 2, 3)
+        # Whether d_tokens was built with the token_kinds column
+        self.token_kinds = True
+
+    def connect(self, dsn=""):
+        return FakeConnection(self)
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    """
+    Stands in for the mimiciv database with a handful of synthetic stays
+    """
+    db = FakeDB(list(range(30000001, 30000065)))
+    monkeypatch.setattr(psycopg2, "connect", db.connect)
+    return db
@@ -0,0 +1,35 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from emrgptdata.mimic import PostgresUtil
+from emrgptdata.inference import TokenDecoder
+
+
+def test_decode(fake_db):
+    decoder = TokenDecoder(PostgresUtil())
+
+    # admission, hour.3, glucose magnitude.4, Heparin mL magnitude.4,
+    # bg.specimen mL (a categorical value, not a uom)
+    events = decoder.decode([[40, 4, 25, 30, 37, 38, 30, 39, 38]], start_hour=2)
+    strings = decoder.to_strings(events)
+
+    assert list(strings["label"]) == [
+        "admission",
+        "chemistry.glucose",
+        "Heparin Sodium",
+        "bg.specimen",
+    ]
+    assert list(strings["uom"]) == [None, None, "mL", None]
+    assert list(strings["value"]) == [None, None, None, "mL"]
+    assert list(events["bin"]) == [-1, 4, 4, -1]
+    assert list(events["hour"]) == [2, 3, 3, 3]
+
+
+def test_training_without_token_kinds(fake_db):
+    fake_db.token_kinds = False
+
+    # Older d_tokens builds still load for training, only decoding needs kinds
+    postgresUtil = PostgresUtil()
+    with pytest.raises(AssertionError, match="token_kinds"):
+        TokenDecoder(postgresUtil)
@@ -0,0 +1,76 @@
+import os
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from torch.utils.data import DataLoader
+from emrgptdata.mimic import TokenStreamDS
+from conftest import fake_stream
+
+
+def make_ds(tmp_path, **kwargs):
+    return TokenStreamDS(block_size=8, cache_dir=str(tmp_path), **kwargs)
+
+
+def open_fds(path: str) -> int:
+    fd_dir = "/proc/self/fd"
+    return sum(
+        1
+        for fd in os.listdir(fd_dir)
+        if os.path.realpath(os.path.join(fd_dir, fd)) == os.path.realpath(path)
+    )
+
+
+def check_batch(ds, indices, batch):
+    for index, (X, memory, y) in zip(indices, batch):
+        stream = fake_stream(int(ds.stay_ids[index]))
+        tokens = [int(i) for i in y if i != 0]
+
+        # y is a contiguous slice of the stay's stream, X is y shifted by one
+        assert any(stream[i : i + len(tokens)] == tokens for i in range(len(stream)))
+        assert torch.equal(X, y[:-1])
+        assert len(memory) == ds.postgresUtil.memory_size
+
+
+def test_getitems_prefetch(tmp_path, fake_db):
+    ds = make_ds(tmp_path, prefetch=4, prefetch_threads=4)
+
+    indices = list(range(len(ds)))
+    check_batch(ds, indices, ds.__getitems__(indices))
+
+
+def test_getitems_prefetch_shared_cache_forked_workers(tmp_path, fake_db):
+    """
+    Prefetch threads in forked DataLoader workers all share one SharedTokenCache
+    """
+    ds = make_ds(tmp_path, shared_cache_bytes=1 << 20, prefetch=4, prefetch_threads=4)
+    cache = ds.postgresUtil.token_cache
+
+    # Use the cache (and the prefetch pool) in the parent before workers fork
+    check_batch(ds, list(range(8)), ds.__getitems__(list(range(8))))
+
+    # The cache's own fd plus the mmap's duplicate of it
+    parent_fds = open_fds(cache.path)
+
+    loader = DataLoader(
+        ds,
+        batch_size=8,
+        num_workers=4,
+        multiprocessing_context="fork",
+        # Runs in the worker: report how many fds it holds on the cache file
+        collate_fn=lambda batch: (batch, open_fds(cache.path)),
+        # A deadlocked worker fails the test instead of hanging it
+        timeout=60,
+    )
+
+    for _ in range(2):
+        for batch_idx, (batch, fds) in enumerate(loader):
+            check_batch(ds, list(range(batch_idx * 8, (batch_idx + 1) * 8)), batch)
+            # Same as the parent, however many prefetch threads share the cache
+            assert fds == parent_fds
+
+    # Every stream was written to the node-wide cache by some process
+    assert len(cache) == len(ds)
+    assert all(
+        list(cache.get(stay_id)) == fake_stream(stay_id) for stay_id in ds.stay_ids
+    )
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from emrgptdata.sharding import balanced_shard_bounds
+
+
+def test_bounds_within_one_stay_of_target():
+    rng = np.random.default_rng(0)
+    lengths = np.exp(rng.normal(5, 1.5, 70000)).astype(np.int64) + 1
+
+    bounds = balanced_shard_bounds(lengths, 16)
+    totals = np.add.reduceat(lengths, bounds[:-1])
+    target = lengths.sum() / 16
+
+    assert np.all(np.abs(totals - target) <= lengths.max())
+
+
+def test_every_shard_gets_a_stay():
+    rng = np.random.default_rng(0)
+    for _ in range(1000):
+        n = int(rng.integers(1, 40))
+        num_shards = int(rng.integers(1, n + 1))
+        lengths = rng.integers(1, 100, n)
+        # One huge stay pulls every target onto itself
+        lengths[rng.integers(n)] *= 1000
+
+        bounds = balanced_shard_bounds(lengths, num_shards)
+
+        assert bounds[0] == 0 and bounds[-1] == n
+        assert np.all(np.diff(bounds) >= 1)
@@ -0,0 +1,97 @@
+import numpy as np
+import os
+import time
+import signal
+import threading
+import pytest
+from numpy.random import default_rng
+from emrgptdata.shmcache import SharedTokenCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = SharedTokenCache(
+        "test", budget_bytes=64 * 1024, max_entries=256, shm_dir=str(tmp_path)
+    )
+    yield cache
+    cache._teardown()
+
+
+def hammer(cache: SharedTokenCache, seed: int, ops: int = 500):
+    rng = default_rng(seed)
+    for _ in range(ops):
+        stay_id = int(rng.integers(1000))
+        if rng.random() < 0.5:
+            cache.put(stay_id, np.full(int(rng.integers(1, 300)), stay_id))
+        else:
+            cached = cache.get(stay_id)
+            assert cached is None or np.all(cached == stay_id)
+
+
+def run_threads(cache: SharedTokenCache, num_threads: int, seed: int):
+    threads = [
+        threading.Thread(target=hammer, args=(cache, seed * num_threads + i))
+        for i in range(num_threads)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def wait_or_kill(pid: int, timeout: float) -> int:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        done, status = os.waitpid(pid, os.WNOHANG)
+        if done:
+            return os.waitstatus_to_exitcode(status)
+        time.sleep(0.01)
+
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+    return -1
+
+
+def test_roundtrip(cache):
+    assert cache.get(1) is None
+    assert cache.put(1, np.arange(10))
+    assert np.array_equal(cache.get(1), np.arange(10))
+    assert len(cache) == 1
+
+
+def test_eviction(cache):
+    for stay_id in range(100):
+        assert cache.put(stay_id, np.full(200, stay_id))
+
+    # 64 KiB holds 40 streams of 1600 bytes, the oldest were evicted
+    assert cache.get(0) is None
+    assert np.all(cache.get(99) == 99)
+    assert len(cache) == 40
+
+
+def test_fork_with_threads(cache):
+    """
+    Forked children each run several threads against the cache at once, as prefetch
+    threads in forked DataLoader workers do. No child may deadlock or leak fds.
+    """
+    # Parent threads keep using the cache, so children fork while it's locked
+    busy = threading.Thread(target=run_threads, args=(cache, 4, 0))
+    busy.start()
+
+    pids = list()
+    for child in range(20):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                fds_before = len(os.listdir("/proc/self/fd"))
+                run_threads(cache, 8, seed=child + 1)
+                code = 0 if len(os.listdir("/proc/self/fd")) == fds_before else 2
+            finally:
+                os._exit(code)
+        pids.append(pid)
+
+    busy.join()
+
+    assert [wait_or_kill(pid, timeout=30) for pid in pids] == [0] * len(pids)
+    hammer(cache, seed=101)